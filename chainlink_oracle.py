@@ -1,14 +1,9 @@
 import configparser
 import time
-import json
 from web3 import Web3
 from web3.middleware import geth_poa_middleware
 from multicall import Call, Multicall
-
-
-# Load config from JSON file
-with open("config.json", "r") as config_file:
-    config = json.load(config_file)
+from maker_config import config
 
 # Read assets information from config file
 price_config = configparser.ConfigParser()
@@ -0,0 +1,51 @@
+import json
+import os
+
+CHECKPOINT_FOLDER = "checkpoints"
+
+# Settlement progress of an event, each one saved before the next step starts
+PAYING = "paying"
+PAID = "paid"
+WITHDRAW_SENT = "withdraw_sent"
+
+
+def checkpoint_path(secret_hash):
+    return os.path.join(CHECKPOINT_FOLDER, f"{secret_hash}.json")
+
+
+def load_checkpoint(secret_hash):
+    try:
+        with open(checkpoint_path(secret_hash), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_checkpoint(secret_hash, **fields):
+    """
+    Merge fields into the event's checkpoint. The file is replaced atomically
+    and synced so a crash leaves either the old or the new checkpoint on disk.
+    It can hold the payment preimage, so it is only readable by the owner.
+    """
+    if not os.path.exists(CHECKPOINT_FOLDER):
+        os.makedirs(CHECKPOINT_FOLDER)
+
+    checkpoint = load_checkpoint(secret_hash) or {}
+    checkpoint.update(fields)
+
+    path = checkpoint_path(secret_hash)
+    tmp_path = path + ".tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(json.dumps(checkpoint))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return checkpoint
+
+
+def clear_checkpoint(secret_hash):
+    try:
+        os.remove(checkpoint_path(secret_hash))
+    except FileNotFoundError:
+        pass
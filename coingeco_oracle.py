@@ -1,30 +1,18 @@
 import requests
 import time
-import traceback
-import json
+from maker_config import config
 
 cache = {}
 cache_timeout = 60  # Cache timeout in seconds
 
-def load_config():
-    try:
-        # Load config from JSON file
-        with open("config.json", "r") as config_file:
-            return json.load(config_file)
-    except Exception as e:
-        errormsg = traceback.format_exc()
-        logging.error(f"Failed to load config.json: {str(e)}\n{errormsg}")
-        return None
-
-config = load_config()
-
-if config is None:
-    logging.error("Unable to load config. Exiting.")
-    exit()
+# Prices fetched for the previous asset list must not outlive a config change
+config.on_reload(cache.clear)
 
 def fetch_prices():
-    if "timestamp" in cache and time.time() - cache["timestamp"] < cache_timeout:
-        return cache["prices"]
+    # (timestamp, prices) under one key, a reload may clear the cache between two reads
+    cached = cache.get("prices")
+    if cached is not None and time.time() - cached[0] < cache_timeout:
+        return cached[1]
 
     url = "https://api.coingecko.com/api/v3/coins/markets"
     params = {
@@ -42,16 +30,12 @@ def fetch_prices():
         if symbol in supported_assets:
             extracted_prices[symbol] = float(price_data["current_price"])
 
-    cache["timestamp"] = time.time()
-    cache["prices"] = extracted_prices
+    cache["prices"] = (time.time(), extracted_prices)
 
     return extracted_prices
 
 def get_supported_tokens():
-    tokens = ["BTC"]
-    for item in config['supported_assets']:
-        tokens.append(item["name"].upper())
-    return tokens
+    return config.asset_symbols
 
 def get_relative_price(token1, token2):
     supported_assets = get_supported_tokens()
@@ -0,0 +1,110 @@
+import json
+
+
+def _hex(value):
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    return value
+
+
+class DepositEvent:
+    """
+    A DepositCreated event decoded once into flat fields.
+    to_dict()/from_dict() keep the layout of the files in pending_events,
+    completed_events and error_events so existing files load unchanged.
+    """
+    __slots__ = (
+        "secret_hash", "depositor", "beneficiary", "token", "amount", "deadline", "invoice",
+        "event", "address", "block_number", "block_hash", "transaction_hash", "transaction_index", "log_index",
+    )
+
+    def __init__(self, secret_hash, depositor, beneficiary, token, amount, deadline, invoice,
+                 event="DepositCreated", address=None, block_number=None, block_hash=None,
+                 transaction_hash=None, transaction_index=None, log_index=None):
+        self.secret_hash = secret_hash
+        self.depositor = depositor
+        self.beneficiary = beneficiary
+        self.token = token
+        self.amount = amount
+        self.deadline = deadline
+        self.invoice = invoice
+        self.event = event
+        self.address = address
+        self.block_number = block_number
+        self.block_hash = block_hash
+        self.transaction_hash = transaction_hash
+        self.transaction_index = transaction_index
+        self.log_index = log_index
+
+    @classmethod
+    def from_log(cls, log):
+        """
+        Build from the AttributeDict returned by get_event_data or an event filter
+        """
+        args = log["args"]
+        return cls(
+            _hex(args["secretHash"]),
+            args["depositor"],
+            args["beneficiary"],
+            args["token"],
+            args["amount"],
+            args["deadline"],
+            args["invoice"],
+            log["event"],
+            log["address"],
+            log["blockNumber"],
+            _hex(log["blockHash"]),
+            _hex(log["transactionHash"]),
+            log["transactionIndex"],
+            log["logIndex"],
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        args = data["args"]
+        return cls(
+            args["secretHash"],
+            args["depositor"],
+            args["beneficiary"],
+            args["token"],
+            args["amount"],
+            args["deadline"],
+            args["invoice"],
+            data.get("event", "DepositCreated"),
+            data.get("address"),
+            data.get("blockNumber"),
+            data.get("blockHash"),
+            data.get("transactionHash"),
+            data.get("transactionIndex"),
+            data.get("logIndex"),
+        )
+
+    @classmethod
+    def from_json(cls, text):
+        return cls.from_dict(json.loads(text))
+
+    def to_dict(self):
+        return {
+            "args": {
+                "secretHash": self.secret_hash,
+                "depositor": self.depositor,
+                "beneficiary": self.beneficiary,
+                "token": self.token,
+                "amount": self.amount,
+                "deadline": self.deadline,
+                "invoice": self.invoice,
+            },
+            "event": self.event,
+            "logIndex": self.log_index,
+            "transactionIndex": self.transaction_index,
+            "transactionHash": self.transaction_hash,
+            "address": self.address,
+            "blockHash": self.block_hash,
+            "blockNumber": self.block_number,
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def __repr__(self):
+        return f"DepositEvent(secret_hash={self.secret_hash!r}, amount={self.amount!r}, token={self.token!r})"
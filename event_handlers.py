@@ -2,42 +2,34 @@ import json
 import logging
 from web3 import Web3
 from web3.middleware import geth_poa_middleware
-import web3.datastructures as wd
 import time
 import os
-import traceback
 import shutil
 import requests
 import codecs
 import grpc
 import base64
 import configparser
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 from coingeco_oracle import get_relative_price
-from bolt11.core import decode
+from maker_config import config
+import metrics
+import liquidity
+from withdraw_batcher import WithdrawBatcher
+import checkpoints
+from checkpoints import load_checkpoint, save_checkpoint, clear_checkpoint
+from web3.exceptions import TransactionNotFound
 import lightning_pb2 as lnrpc, lightning_pb2_grpc as lightningstub
 import router_pb2 as routerrpc, router_pb2_grpc as routerstub
 
-def load_config():
-    try:
-        # Load config from JSON file
-        with open("config.json", "r") as config_file:
-            return json.load(config_file)
-    except Exception as e:
-        errormsg = traceback.format_exc()
-        logging.error(f"Failed to load config.json: {str(e)}\n{errormsg}")
-        return None
-
-config = load_config()
-
-if config is None:
-    logging.error("Unable to load config. Exiting.")
-    exit()
-
 def setup_web3_connection():
     try:
         # Set up connection to Ethereum node
         w3 = Web3(Web3.HTTPProvider(config["provider"]))
         w3.middleware_onion.inject(geth_poa_middleware, layer=0)
+        w3.middleware_onion.add(metrics.rpc_metrics_middleware, "metrics")
 
         # Verify connection
         if not w3.is_connected():
@@ -46,28 +38,108 @@ def setup_web3_connection():
 
         return w3
     except Exception as e:
-        errormsg = traceback.format_exc()
-        logging.error(f"Failed to set up web3 connection: {str(e)}\n{errormsg}")
+        logging.exception(f"Failed to set up web3 connection: {str(e)}")
         return None
 
-w3 = setup_web3_connection()
-if w3 is None:
-    logging.error("Unable to set up web3 connection. Exiting.")
-    exit()
-
-
-macaroon = codecs.encode(open(config['lnd']['macaroon_path'], 'rb').read(), 'hex')
-def metadata_callback(context, callback):
-    callback([('macaroon', macaroon)], None)
-auth_creds = grpc.metadata_call_credentials(metadata_callback)
-os.environ['GRPC_SSL_CIPHER_SUITES'] = 'HIGH+ECDSA'
-cert = open(config['lnd']['tls_cert_path'], 'rb').read()
-ssl_creds = grpc.ssl_channel_credentials(cert)
-combined_creds = grpc.composite_channel_credentials(ssl_creds, auth_creds)
-channel = grpc.secure_channel(config['lnd']['ln_rpc_server'], combined_creds)
-stub = lightningstub.LightningStub(channel)
-rtstub = routerstub.RouterStub(channel)
-
+def setup_lnd_connection():
+    macaroon = codecs.encode(open(config['lnd']['macaroon_path'], 'rb').read(), 'hex')
+    def metadata_callback(context, callback):
+        callback([('macaroon', macaroon)], None)
+    auth_creds = grpc.metadata_call_credentials(metadata_callback)
+    os.environ['GRPC_SSL_CIPHER_SUITES'] = 'HIGH+ECDSA'
+    cert = open(config['lnd']['tls_cert_path'], 'rb').read()
+    ssl_creds = grpc.ssl_channel_credentials(cert)
+    combined_creds = grpc.composite_channel_credentials(ssl_creds, auth_creds)
+    channel = grpc.intercept_channel(
+        grpc.secure_channel(config['lnd']['ln_rpc_server'], combined_creds),
+        metrics.GrpcMetricsInterceptor()
+    )
+    return lightningstub.LightningStub(channel), routerstub.RouterStub(channel)
+
+# Node and LND connections, opened by connect() so the handler logic can be
+# imported without them, e.g. by replay_events.py
+w3 = None
+stub = None
+rtstub = None
+
+def connect():
+    global w3, stub, rtstub
+    w3 = setup_web3_connection()
+    if w3 is None:
+        logging.error("Unable to set up web3 connection. Exiting.")
+        exit()
+    stub, rtstub = setup_lnd_connection()
+
+# Runs the independent stages of a handler concurrently
+stage_threads = config.get("settlement", {}).get("stage_threads", 4)
+stage_executor = ThreadPoolExecutor(max_workers=stage_threads, thread_name_prefix="stage")
+
+def run_stage(fn, *args):
+    # Copy the context so records logged by the stage keep the event id
+    return stage_executor.submit(contextvars.copy_context().run, fn, *args)
+
+# Held from nonce lookup until the transaction is sent, replaced with a
+# process-shared lock when several settlement workers use the same bot wallet
+nonce_lock = nullcontext()
+
+def reconnect():
+    """
+    Open the node and LND connections and a fresh stage pool in a settlement
+    worker, gRPC channels and HTTP sessions must not be shared across processes
+    """
+    global stage_executor
+    connect()
+    stage_executor = ThreadPoolExecutor(max_workers=stage_threads, thread_name_prefix="stage")
+
+
+# Liquidity ledger for admission control, started by start_liquidity_ledger
+liquidity_ledger = None
+
+# Returned by an event handler to leave the event pending and retry it later
+DEFERRED = "deferred"
+
+# Returned by an event handler once the withdraw is queued for a batch, the
+# batcher reports the outcome through its on_done callback
+SUBMITTED = "submitted"
+
+# Batches delegateWithdraw calls when enabled, started by start_withdraw_batcher
+withdraw_batcher = None
+
+def start_liquidity_ledger(state=None, slot=0):
+    """
+    state is the LedgerState shared by all settlement workers, slot the
+    worker's index in it; a single process uses a private state
+    """
+    global liquidity_ledger
+    liquidity_config = config.get("liquidity", {})
+    if not liquidity_config.get("enabled", False):
+        return
+    liquidity_ledger = liquidity.LiquidityLedger(
+        stub, liquidity_config.get("refresh_interval", 10), liquidity_config.get("max_age", 60), state, slot
+    )
+    liquidity_ledger.start()
+
+def start_withdraw_batcher(on_done):
+    global withdraw_batcher
+    batching_config = config.get("withdraw_batching", {})
+    if not batching_config.get("enabled", False):
+        return
+    withdraw_batcher = WithdrawBatcher(
+        w3,
+        Web3.to_checksum_address(batching_config["aggregator_address"]),
+        config["maker_bot_address"],
+        config["maker_bot_privatekey"],
+        batching_config.get("max_size", 20),
+        batching_config.get("max_delay", 10),
+        nonce_lock,
+        on_done,
+        on_withdraw_batch_sent,
+    )
+    withdraw_batcher.start()
+
+def on_withdraw_batch_sent(events, transaction_hash):
+    for event in events:
+        save_checkpoint(event.secret_hash, state=checkpoints.WITHDRAW_SENT, withdraw_tx=transaction_hash.hex(), batched=True)
 
 # Simplify error handling with a wrapper function
 def move_event_on_error(error_message, event):
@@ -76,43 +148,53 @@ def move_event_on_error(error_message, event):
 
 # Your event handling function
 def handle_DepositCreated(event):
-    global config
-
-    secret_hash = event["args"]["secretHash"]
-    depositor = event["args"]["depositor"]
-    beneficiary = event["args"]["beneficiary"]
-    token = event["args"]["token"]
-    amount = event["args"]["amount"]
-    deadline = event["args"]["deadline"]
-    invoice = event["args"]["invoice"]
-    contract_address = event["address"]
+    secret_hash = event.secret_hash
+    depositor = event.depositor
+    beneficiary = event.beneficiary
+    token = event.token
+    amount = event.amount
+    deadline = event.deadline
+    invoice = event.invoice
+    contract_address = event.address
     maker_wallet_address = config['maker_wallet_address']
 
     isNative = check_if_native_coin(contract_address)
 
     logging.info(f"Event received: DepositCreated, secretHash: {secret_hash}, depositor: {depositor}, beneficiary: {beneficiary}, token: {token}, amount: {amount}, deadline: {deadline}, invoice: {invoice}")
 
+    # Pick up after the last step a previous run finished instead of paying again
+    checkpoint = load_checkpoint(secret_hash)
+    if checkpoint is not None:
+        resumed = resume_from_checkpoint(event, checkpoint, maker_wallet_address, isNative)
+        if resumed is not None:
+            return resumed
+
     if beneficiary.lower() != maker_wallet_address.lower():
         log_event_on_error("The beneficiary does not match the maker wallet address.", event)
         return True
 
-    token_info = get_token_info(token, config['supported_assets'])
+    token_info = get_token_info(token)
     if token_info is None:
         log_event_on_error(f"Doesn't support this TOKEN {token}.", event)
         return True
 
-    oracle_price = get_oracle_price("btc", token_info["name"])
-    if oracle_price is None:
-        log_event_on_error("Failed to get price from oracle.", event)
-        return False
+    # The oracle price and the invoice decode don't depend on each other
+    oracle_future = run_stage(get_oracle_price, "btc", token_info["name"])
+    invoice_future = run_stage(get_invoice_info, invoice)
 
-    invoice_info = get_invoice_info(invoice)
+    invoice_info = invoice_future.result()
     if invoice_info is None:
         log_event_on_error("Can't to decode invoice.", event)
         return False
 
-    if invoice_info.num_satoshis > 50000:
-        log_event_on_error("The invoice amount over the max amount 50,000 sats.", event)
+    oracle_price = oracle_future.result()
+    if oracle_price is None:
+        log_event_on_error("Failed to get price from oracle.", event)
+        return False
+
+    max_invoice_sats = get_max_invoice_sats(token_info)
+    if invoice_info.num_satoshis > max_invoice_sats:
+        log_event_on_error(f"The invoice amount over the max amount {max_invoice_sats:,} sats.", event)
         return False
 
     event_btc_price = calculate_event_btc_price(amount, token_info["decimals"], invoice_info.num_satoshis)
@@ -129,38 +211,104 @@ def handle_DepositCreated(event):
         log_event_on_error("The deadline in the event is less than 30 minutes from now.", event)
         return False
 
-    secret = pay_invoice(invoice)
+    if liquidity_ledger is not None:
+        admission = liquidity_ledger.reserve(invoice_info.num_satoshis)
+        if admission == liquidity.REJECT:
+            log_event_on_error(f"No channel can carry {invoice_info.num_satoshis} sats.", event)
+            return False
+        if admission == liquidity.DEFER:
+            logging.info(f"Not enough outbound liquidity for {invoice_info.num_satoshis} sats, deferring event {secret_hash}")
+            return DEFERRED
+
+    save_checkpoint(secret_hash, state=checkpoints.PAYING)
+    secret = None
+    try:
+        secret = pay_invoice(invoice)
+    finally:
+        if liquidity_ledger is not None:
+            liquidity_ledger.release(invoice_info.num_satoshis, spent=secret is not None)
     if secret is None:
         log_event_on_error("Failed to pay invoice and get secret.", event)
         return False
+    save_checkpoint(secret_hash, state=checkpoints.PAID, preimage=secret)
+
+    return settle_withdraw(event, secret, maker_wallet_address, isNative)
+
+def settle_withdraw(event, secret, maker_wallet_address, isNative):
+    if withdraw_batcher is not None:
+        contract_instance = get_swap_contract(isNative)
+        calldata = contract_instance.encodeABI(fn_name="delegateWithdraw", args=[secret, maker_wallet_address])
+        if not withdraw_batcher.submit(event, contract_instance.address, Web3.to_bytes(hexstr=calldata)):
+            logging.info(f"Withdraw for event {event.secret_hash} is already waiting in a batch")
+        return SUBMITTED
 
-    if not delegate_withdraw(secret, maker_wallet_address, isNative):
+    def on_sent(transaction_hash):
+        save_checkpoint(event.secret_hash, state=checkpoints.WITHDRAW_SENT, withdraw_tx=transaction_hash.hex())
+
+    if not delegate_withdraw(secret, maker_wallet_address, isNative, on_sent):
         log_event_on_error("Failed to call delegateRefund.", event)
         return False
 
     return True
 
-def check_if_native_coin(contract_address):
-    native_contract_address = config["native_contract_address"].lower()
-    token_contract_address = config["token_contract_address"].lower()
-    if contract_address.lower() == native_contract_address:
-        return True
-    if contract_address.lower() == token_contract_address:
-        return False
-    return None
+def resume_from_checkpoint(event, checkpoint, maker_wallet_address, isNative):
+    """
+    Finish an event from its checkpoint. Returns None when nothing was paid
+    yet and the event has to be handled from the start, DEFERRED when LND
+    could not tell whether an earlier payment went through.
+    """
+    secret_hash = event.secret_hash
+    state = checkpoint.get("state")
+
+    if state == checkpoints.WITHDRAW_SENT:
+        logging.info(f"Resuming event {secret_hash} at withdraw transaction {checkpoint['withdraw_tx']}")
+        success = get_withdraw_status(checkpoint["withdraw_tx"])
+        if success is False and checkpoint.get("batched"):
+            # Any failing call reverts a batch, this one's call may still succeed
+            logging.warning(f"Withdraw batch {checkpoint['withdraw_tx']} reverted, sending the withdraw again")
+            state = checkpoints.PAID
+        elif success is False:
+            log_event_on_error(f"Withdraw transaction {checkpoint['withdraw_tx']} failed.", event)
+            return False
+        elif success:
+            return True
+        else:
+            # The node no longer knows the transaction, send the withdraw again
+            state = checkpoints.PAID
+
+    if state == checkpoints.PAID:
+        logging.info(f"Resuming event {secret_hash} from its paid invoice")
+        return settle_withdraw(event, checkpoint["preimage"], maker_wallet_address, isNative)
+
+    if state == checkpoints.PAYING:
+        # The payment may have gone through before the crash
+        try:
+            secret = lookup_payment(secret_hash)
+        except grpc.RpcError as e:
+            logging.warning(f"Failed to look up payment {secret_hash}, retrying later: {e.code()}")
+            return DEFERRED
+        if secret is not None:
+            logging.info(f"Resuming event {secret_hash} from a payment made before restart")
+            save_checkpoint(secret_hash, state=checkpoints.PAID, preimage=secret)
+            return settle_withdraw(event, secret, maker_wallet_address, isNative)
 
-def get_token_info(token, supported_assets):
-    for item in supported_assets:
-        if token.lower() == item["address"].lower():
-            return item
     return None
 
+def check_if_native_coin(contract_address):
+    return config.is_native_contract(contract_address)
+
+def get_token_info(token):
+    return config.get_token_info(token)
+
+def get_max_invoice_sats(token_info):
+    return token_info.get("max_invoice_sats", config.get("max_invoice_sats", 50000))
+
 def get_oracle_price(base_asset, quote_asset):
     try:
-        return get_relative_price(base_asset, quote_asset)
+        with metrics.time_stage("oracle"):
+            return get_relative_price(base_asset, quote_asset)
     except Exception as e:
-        errormsg = traceback.format_exc()
-        logging.error(f"Failed to get price from Chainlink: {str(e)}\n{errormsg}")
+        logging.exception(f"Failed to get price from Chainlink: {str(e)}")
     return None
 
 def get_invoice_info(invoice):
@@ -168,13 +316,11 @@ def get_invoice_info(invoice):
         request = lnrpc.PayReqString(
             pay_req=invoice,
         )
-        return stub.DecodePayReq(request)
+        with metrics.time_stage("invoice_decode"):
+            return stub.DecodePayReq(request)
 
     except Exception as e:
-        errormsg = traceback.format_exc()
-        logging.error(f"Failed to decode invoice: {str(e)}\n{errormsg}")
-        move_event(event, 'error_events')
-        return False
+        logging.exception(f"Failed to decode invoice: {str(e)}")
 
     return None
 
@@ -191,23 +337,61 @@ def validate_deadline(deadline):
     return deadline >= time.time() + 1800
 
 def pay_invoice(invoice):
+    """
+    Preimage of the paid invoice, None unless LND reports the payment as succeeded
+    """
     try:
-        response = stub.SendPaymentSync(lnrpc.SendRequest(payment_request=invoice))
-        result = ""
-        for response in rtstub.TrackPaymentV2(routerrpc.TrackPaymentRequest(payment_hash=response.payment_hash)):
-            secret = response.payment_preimage
-            logging.info(f"{response.payment_hash}")
-        
-        return "0x" + str(secret)
+        with metrics.time_stage("pay"):
+            response = stub.SendPaymentSync(lnrpc.SendRequest(payment_request=invoice))
+            request = routerrpc.TrackPaymentRequest(payment_hash=response.payment_hash, no_inflight_updates=True)
+            for payment in rtstub.TrackPaymentV2(request):
+                logging.info(f"{payment.payment_hash}")
+                if payment.status == lnrpc.Payment.SUCCEEDED:
+                    return "0x" + str(payment.payment_preimage)
+                if payment.status == lnrpc.Payment.FAILED:
+                    # A failed payment carries an all-zero preimage
+                    logging.error(f"Payment {payment.payment_hash} failed: {lnrpc.PaymentFailureReason.Name(payment.failure_reason)}")
+                    return None
+        return None
     except Exception as e:
-        errormsg = traceback.format_exc()
-        logging.error(f"Failed to pay invoice and get secret: {str(e)}\n{errormsg}")
+        logging.exception(f"Failed to pay invoice and get secret: {str(e)}")
         return None
 
-def delegate_withdraw(secret, maker_wallet_address, isNative):
-    global config
-    bot_address = config["maker_bot_address"]
-    bot_private_key = config["maker_bot_privatekey"]
+def lookup_payment(payment_hash):
+    """
+    Preimage of an earlier payment to payment_hash, None if LND has no
+    successful payment for it. Other gRPC errors are raised, since the
+    payment may still have gone through.
+    """
+    try:
+        request = routerrpc.TrackPaymentRequest(payment_hash=bytes.fromhex(payment_hash), no_inflight_updates=True)
+        for payment in rtstub.TrackPaymentV2(request):
+            if payment.status == lnrpc.Payment.SUCCEEDED:
+                return "0x" + str(payment.payment_preimage)
+            if payment.status == lnrpc.Payment.FAILED:
+                return None
+    except grpc.RpcError as e:
+        # The payment was never initiated
+        if e.code() != grpc.StatusCode.NOT_FOUND:
+            raise
+    return None
+
+def get_withdraw_status(transaction_hash):
+    """
+    True/False for a mined withdraw transaction, None if the node doesn't know it
+    """
+    try:
+        w3.eth.get_transaction(transaction_hash)
+    except TransactionNotFound:
+        return None
+
+    with metrics.time_stage("receipt"):
+        transaction_receipt = w3.eth.wait_for_transaction_receipt(transaction_hash)
+    return transaction_receipt['status'] == 1
+
+contract_abis = {}
+
+def get_swap_contract(isNative):
     contract_address = config["token_contract_address"]
     contract_abi = config["token_contract_abi"]
 
@@ -215,60 +399,57 @@ def delegate_withdraw(secret, maker_wallet_address, isNative):
         contract_address = config["native_contract_address"]
         contract_abi = config["native_contract_abi"]
 
-    with open(contract_abi, "r") as abi_file:
-        token_contract_abi = json.load(abi_file)
-
-    contract_instance = w3.eth.contract(address=contract_address, abi=token_contract_abi)
+    if contract_abi not in contract_abis:
+        with open(contract_abi, "r") as abi_file:
+            contract_abis[contract_abi] = json.load(abi_file)
 
-    # Get the nonce for the transaction
-    nonce = w3.eth.get_transaction_count(bot_address)
+    return w3.eth.contract(address=contract_address, abi=contract_abis[contract_abi])
 
-    # Estimate the gas limit
-    gas_limit = int(contract_instance.functions.delegateWithdraw(secret, maker_wallet_address).estimate_gas() * 1.3)
+def delegate_withdraw(secret, maker_wallet_address, isNative, on_sent=None):
+    bot_address = config["maker_bot_address"]
+    bot_private_key = config["maker_bot_privatekey"]
 
-    # Build the transaction dictionary
-    transaction = contract_instance.functions.delegateWithdraw(secret, maker_wallet_address).build_transaction({
-        'gas': gas_limit,
-        'gasPrice': w3.eth.gas_price,
-        'nonce': nonce
-    })
-    # transaction = contract_instance.encodeABI(fn_name="delegateWithdraw", args=[secret, maker_wallet_address])
-    # Sign the transaction
-    signed_transaction = w3.eth.account.sign_transaction(transaction, bot_private_key)
+    contract_instance = get_swap_contract(isNative)
 
-    # Send the transaction
-    transaction_hash = w3.eth.send_raw_transaction(signed_transaction.rawTransaction)
+    # Estimate the gas limit
+    with metrics.time_stage("gas_estimate"):
+        gas_limit = int(contract_instance.functions.delegateWithdraw(secret, maker_wallet_address).estimate_gas() * 1.3)
+
+    with nonce_lock:
+        # Get the nonce for the transaction, counting ones still in the mempool
+        nonce = w3.eth.get_transaction_count(bot_address, 'pending')
+
+        # Build the transaction dictionary
+        transaction = contract_instance.functions.delegateWithdraw(secret, maker_wallet_address).build_transaction({
+            'gas': gas_limit,
+            'gasPrice': w3.eth.gas_price,
+            'nonce': nonce
+        })
+        # transaction = contract_instance.encodeABI(fn_name="delegateWithdraw", args=[secret, maker_wallet_address])
+        # Sign the transaction
+        signed_transaction = w3.eth.account.sign_transaction(transaction, bot_private_key)
+
+        # Send the transaction
+        with metrics.time_stage("send"):
+            transaction_hash = w3.eth.send_raw_transaction(signed_transaction.rawTransaction)
 
     logging.info(f"sending withdraw transaction {transaction_hash.hex()}")
+    if on_sent is not None:
+        on_sent(transaction_hash)
 
     # Wait for the transaction receipt
-    transaction_receipt = w3.eth.wait_for_transaction_receipt(transaction_hash)
+    with metrics.time_stage("receipt"):
+        transaction_receipt = w3.eth.wait_for_transaction_receipt(transaction_hash)
 
     # Check if the transaction was successful
     return transaction_receipt['status'] == 1
 
 def log_event_on_error(error_message, event):
-    new_event = attribute_dict_to_dict(event)
-    event_id = new_event["args"]["secretHash"]
-    logging.error(f"[{event_id}] : {error_message}")
-
-def attribute_dict_to_dict(attribute_dict):
-    result = {}
-    for key, value in attribute_dict.items():
-        if isinstance(value, wd.AttributeDict):
-            result[key] = attribute_dict_to_dict(value)
-        elif isinstance(value, dict):
-            result[key] = attribute_dict_to_dict(value)
-        elif isinstance(value, (bytes, bytearray)):
-            result[key] = str(value.hex())
-        else:
-            result[key] = value
-    return result
+    event_id = event.secret_hash
+    logging.error(f"[{event_id}] : {error_message}", extra={"event_id": event_id})
 
 def check_event_exists(event, target_folder):
-    new_event = attribute_dict_to_dict(event)
-    event_id = new_event["args"]["secretHash"]
-    file_name = os.path.join(target_folder, f"{event_id}.json")
+    file_name = os.path.join(target_folder, f"{event.secret_hash}.json")
 
     return os.path.exists(file_name)
 
@@ -276,21 +457,24 @@ def save_event_to(event, target_folder):
     if not os.path.exists(target_folder):
         os.makedirs(target_folder)
 
-    new_event = attribute_dict_to_dict(event)
-    event_id = new_event["args"]["secretHash"]
-    file_name = os.path.join(target_folder, f"{event_id}.json")
+    file_name = os.path.join(target_folder, f"{event.secret_hash}.json")
 
     with open(file_name, 'w') as f:
-        f.write(json.dumps(new_event))
+        f.write(event.to_json())
+
+    return event
 
-    return new_event
 def move_event(event, target_folder):
     if not os.path.exists(target_folder):
         os.makedirs(target_folder)
 
-    event_id = event["args"]["secretHash"]
+    event_id = event.secret_hash
     src = os.path.join('pending_events', f"{event_id}.json")
     dst = os.path.join(target_folder, f"{event_id}.json")
 
     shutil.move(src, dst)
     logging.info(f"Moved event file {event_id}.json from 'pending_events' to '{target_folder}'")
+
+    # Checkpoints of failed events are kept, they may hold the preimage of a paid invoice
+    if target_folder == 'completed_events':
+        clear_checkpoint(event_id)
@@ -0,0 +1,103 @@
+import logging
+import multiprocessing
+import threading
+import time
+
+import lightning_pb2 as lnrpc
+
+ADMIT = "admit"
+DEFER = "defer"
+REJECT = "reject"
+
+
+class LedgerState:
+    """
+    Cached balances and reservations in shared memory, so every settlement
+    worker started by the leader reserves against the same liquidity.
+    Reservations are kept per slot (one per worker) so the leader can drop
+    those of a worker that died mid-payment.
+    """
+    def __init__(self, slots=1, ctx=multiprocessing):
+        self.lock = ctx.Lock()
+        self.total_sendable = ctx.RawValue("q", 0)
+        self.max_channel_sendable = ctx.RawValue("q", 0)
+        self.max_channel_capacity = ctx.RawValue("q", 0)
+        # time.monotonic() of the last refresh, 0 until the first one
+        self.updated_at = ctx.RawValue("d", 0.0)
+        self.reserved = ctx.RawArray("q", slots)
+
+    def clear_slot(self, slot):
+        with self.lock:
+            self.reserved[slot] = 0
+
+
+class LiquidityLedger:
+    """
+    Outbound liquidity cached from LND ListChannels/ChannelBalance and refreshed
+    in a background thread. Payments reserve their amount before being sent so
+    concurrent payments never promise more than the channels can carry.
+    """
+    def __init__(self, stub, refresh_interval=10, max_age=60, state=None, slot=0):
+        self.stub = stub
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self.state = state or LedgerState()
+        self.slot = slot
+        self.thread = None
+
+    def start(self):
+        self.refresh()
+        self.thread = threading.Thread(target=self._run, name="liquidity-ledger", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            self.refresh()
+
+    def refresh(self):
+        try:
+            channels = self.stub.ListChannels(lnrpc.ListChannelsRequest()).channels
+            balance = self.stub.ChannelBalance(lnrpc.ChannelBalanceRequest())
+        except Exception as e:
+            logging.exception(f"Failed to refresh channel balances: {str(e)}")
+            return
+
+        # SendPaymentSync uses a single path, so one channel must carry the whole amount
+        sendable = [max(channel.local_balance - channel.local_chan_reserve_sat, 0) for channel in channels if channel.active]
+        capacity = [max(channel.capacity - channel.local_chan_reserve_sat, 0) for channel in channels]
+        state = self.state
+        with state.lock:
+            state.total_sendable.value = min(sum(sendable), balance.local_balance.sat)
+            state.max_channel_sendable.value = max(sendable, default=0)
+            state.max_channel_capacity.value = max(capacity, default=0)
+            state.updated_at.value = time.monotonic()
+
+    def reserve(self, sats):
+        """
+        REJECT when no open channel could ever carry the amount, DEFER when the
+        balances are stale or currently committed to other payments
+        """
+        state = self.state
+        with state.lock:
+            updated_at = state.updated_at.value
+            if not updated_at or time.monotonic() - updated_at > self.max_age:
+                return DEFER
+            if state.max_channel_capacity.value and sats > state.max_channel_capacity.value:
+                return REJECT
+            # Any outstanding payment may be routed over the largest channel,
+            # so count every reservation against it as well as the total
+            reserved = sum(state.reserved)
+            if reserved + sats > state.max_channel_sendable.value or reserved + sats > state.total_sendable.value:
+                return DEFER
+            state.reserved[self.slot] += sats
+            return ADMIT
+
+    def release(self, sats, spent=False):
+        state = self.state
+        with state.lock:
+            state.reserved[self.slot] -= sats
+            if spent:
+                # Keep the cached balances honest until the next refresh
+                state.total_sendable.value = max(state.total_sendable.value - sats, 0)
+                state.max_channel_sendable.value = max(state.max_channel_sendable.value - sats, 0)
@@ -0,0 +1,137 @@
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+# secretHash of the event being settled, attached to every record logged while handling it
+current_event_id = contextvars.ContextVar("current_event_id", default=None)
+
+TEXT_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
+
+
+def set_event_id(event_id):
+    return current_event_id.set(event_id)
+
+
+def reset_event_id(token):
+    current_event_id.reset(token)
+
+
+class EventContextFilter(logging.Filter):
+    def filter(self, record):
+        if getattr(record, "event_id", None) is None:
+            record.event_id = current_event_id.get()
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most `burst` identical messages per call site and event through every
+    `interval` seconds and reports how many were dropped on the first record of
+    the next window. It is attached to the queue handler, so it runs on every
+    thread that logs, before the record is queued: the windows are shared
+    between those threads and locked, and the filter must stay cheap.
+    """
+    def __init__(self, interval=60, burst=5):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.pathname, record.lineno, str(record.msg), getattr(record, "event_id", None))
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                if window is None and len(self.windows) >= 10000:
+                    self.prune(now)
+                self.windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+    def prune(self, now):
+        for key, window in list(self.windows.items()):
+            if now - window[0] >= self.interval:
+                del self.windows[key]
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        for field in ("event_id", "stage", "duration", "suppressed"):
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueues records unformatted so tracebacks and JSON are rendered on the listener thread
+    """
+    def prepare(self, record):
+        return record
+
+
+def log_file_path(configured, process_name):
+    """
+    One file per process, RotatingFileHandler can't share a file across
+    processes: event_listener.log becomes event_listener_token_worker0.log
+    """
+    if not configured:
+        return f"event_listener_{process_name}.log"
+    base, ext = os.path.splitext(configured)
+    return f"{base}_{process_name}{ext or '.log'}"
+
+
+def setup_logging(config, process_name):
+    """
+    Route the root logger through a queue drained by a background listener
+    writing JSON lines to a rotating file and plain text to the console.
+    Returns the started listener, call stop() on it at shutdown to flush.
+    """
+    logging_config = config.get("logging", {})
+    rate_limit = logging_config.get("rate_limit", {})
+
+    file_handler = logging.handlers.RotatingFileHandler(
+        log_file_path(logging_config.get("file"), process_name),
+        maxBytes=logging_config.get("max_bytes", 10 * 1024 * 1024),
+        backupCount=logging_config.get("backup_count", 5),
+    )
+    file_handler.setFormatter(JsonFormatter())
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(EventContextFilter())
+    queue_handler.addFilter(RateLimitFilter(rate_limit.get("interval", 60), rate_limit.get("burst", 5)))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(logging_config.get("level", "INFO"))
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,119 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from eth_utils import to_checksum_address
+
+CONFIG_FILE = "config.json"
+
+
+class ConfigSnapshot:
+    """
+    One parsed version of config.json with its lookup indexes, never mutated
+    after construction so readers always see a consistent set of values
+    """
+    __slots__ = ("data", "assets_by_address", "contract_kinds", "asset_symbols")
+
+    def __init__(self, data):
+        self.data = data
+        self.assets_by_address = {}
+        for item in data["supported_assets"]:
+            self.assets_by_address[item["address"].lower()] = item
+            self.assets_by_address[to_checksum_address(item["address"])] = item
+
+        # contract address -> True for the native swap contract, False for the token one
+        self.contract_kinds = {}
+        for key, is_native in (("native_contract_address", True), ("token_contract_address", False)):
+            self.contract_kinds[data[key].lower()] = is_native
+            self.contract_kinds[to_checksum_address(data[key])] = is_native
+
+        self.asset_symbols = frozenset(["BTC"] + [item["name"].upper() for item in data["supported_assets"]])
+
+
+class MakerConfig:
+    """
+    config.json shared by every module. Reads behave like the plain dict
+    (config["provider"], config.get(...)) and go to the latest snapshot, which
+    a watcher thread replaces when the file changes on disk. Connection
+    settings are only read at startup; assets, caps and oracle settings take
+    effect for the next event handled.
+    """
+    def __init__(self, path=CONFIG_FILE):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        self.snapshot = ConfigSnapshot(self._read())
+        self.reload_callbacks = []
+        self.watcher = None
+
+    def _read(self):
+        with open(self.path, "r") as config_file:
+            return json.load(config_file)
+
+    def __getitem__(self, key):
+        return self.snapshot.data[key]
+
+    def __contains__(self, key):
+        return key in self.snapshot.data
+
+    def get(self, key, default=None):
+        return self.snapshot.data.get(key, default)
+
+    def get_token_info(self, token):
+        assets = self.snapshot.assets_by_address
+        return assets.get(token) or assets.get(token.lower())
+
+    def is_native_contract(self, contract_address):
+        kinds = self.snapshot.contract_kinds
+        if contract_address in kinds:
+            return kinds[contract_address]
+        return kinds.get(contract_address.lower())
+
+    @property
+    def asset_symbols(self):
+        return self.snapshot.asset_symbols
+
+    def on_reload(self, callback):
+        self.reload_callbacks.append(callback)
+
+    def reload_if_changed(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self.mtime:
+                return False
+            snapshot = ConfigSnapshot(self._read())
+        except Exception as e:
+            # Keep serving the previous version, a half written file is retried on the next check
+            logging.exception(f"Failed to reload {self.path}: {str(e)}")
+            return False
+
+        self.mtime = mtime
+        self.snapshot = snapshot
+        logging.info(f"Reloaded {self.path}")
+        for callback in self.reload_callbacks:
+            callback()
+        return True
+
+    def start_watcher(self, interval=5):
+        self.watcher = threading.Thread(target=self._watch, args=(interval,), name="config-watcher", daemon=True)
+        self.watcher.start()
+
+    def _watch(self, interval):
+        while True:
+            time.sleep(interval)
+            self.reload_if_changed()
+
+
+def load_config():
+    try:
+        return MakerConfig()
+    except Exception as e:
+        logging.exception(f"Failed to load {CONFIG_FILE}: {str(e)}")
+        return None
+
+config = load_config()
+
+if config is None:
+    logging.error("Unable to load config. Exiting.")
+    exit()
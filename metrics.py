@@ -0,0 +1,132 @@
+import logging
+import time
+from contextlib import contextmanager
+import grpc
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram, start_http_server
+
+# Latency of each step of handle_DepositCreated
+STAGE_LATENCY = Histogram(
+    "maker_stage_latency_seconds",
+    "Latency of each settlement stage",
+    ["stage"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+
+QUEUE_DEPTH = Gauge("maker_event_queue_depth", "Events waiting in the settlement queue")
+BLOCKS_BEHIND = Gauge("maker_blocks_behind_head", "Blocks between the event cursor and the chain head")
+BACKFILL_BLOCKS = Counter("maker_backfill_blocks_total", "Blocks scanned while fetching events")
+BACKFILL_EVENTS = Counter("maker_backfill_events_total", "Events found while fetching events")
+
+# backend is "rpc" for the Ethereum node and "grpc" for LND
+RPC_CALLS = Counter("maker_rpc_calls_total", "RPC/gRPC calls issued", ["backend", "method"])
+RPC_ERRORS = Counter("maker_rpc_errors_total", "RPC/gRPC calls that failed", ["backend", "method"])
+
+
+def start_metrics_server(config, process_name, worker=None):
+    """
+    Serve this process's metrics, settlement worker N of a listener uses
+    <process_name>_worker_base_port + N
+    """
+    metrics_config = config.get("metrics", {})
+    if not metrics_config.get("enabled", False):
+        return
+    if worker is None:
+        port = metrics_config[f"{process_name}_port"]
+    else:
+        port = metrics_config[f"{process_name}_worker_base_port"] + worker
+    host = metrics_config.get("host", "127.0.0.1")
+    start_http_server(port, addr=host)
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+
+def reset_for_worker():
+    """
+    Drop the leader's metrics from a settlement worker: the leader keeps
+    reporting ingestion and queue metrics, the worker only reports its own
+    stage and RPC series
+    """
+    for metric in (QUEUE_DEPTH, BLOCKS_BEHIND, BACKFILL_BLOCKS, BACKFILL_EVENTS):
+        REGISTRY.unregister(metric)
+    for metric in (STAGE_LATENCY, RPC_CALLS, RPC_ERRORS):
+        metric.clear()
+
+
+@contextmanager
+def time_stage(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_LATENCY.labels(stage).observe(duration)
+        logging.info(f"Stage {stage} took {duration:.3f}s", extra={"stage": stage, "duration": duration})
+
+
+def rpc_metrics_middleware(make_request, w3):
+    """
+    web3 middleware counting every JSON-RPC request and error by method
+    """
+    def middleware(method, params):
+        RPC_CALLS.labels("rpc", method).inc()
+        try:
+            response = make_request(method, params)
+        except Exception:
+            RPC_ERRORS.labels("rpc", method).inc()
+            raise
+        if "error" in response:
+            RPC_ERRORS.labels("rpc", method).inc()
+        return response
+    return middleware
+
+
+def _grpc_method_name(client_call_details):
+    method = client_call_details.method
+    if isinstance(method, bytes):
+        method = method.decode()
+    return method.rsplit("/", 1)[-1]
+
+
+class _ErrorCountingStream:
+    """
+    Wraps a streaming call so errors raised while iterating it are counted
+    """
+    def __init__(self, call, method):
+        self._call = call
+        self._method = method
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._call)
+        except grpc.RpcError:
+            RPC_ERRORS.labels("grpc", self._method).inc()
+            raise
+
+    def __getattr__(self, name):
+        return getattr(self._call, name)
+
+
+class GrpcMetricsInterceptor(grpc.UnaryUnaryClientInterceptor, grpc.UnaryStreamClientInterceptor):
+    """
+    Counts LND gRPC calls and errors, use with grpc.intercept_channel
+    """
+    def intercept_unary_unary(self, continuation, client_call_details, request):
+        method = _grpc_method_name(client_call_details)
+        RPC_CALLS.labels("grpc", method).inc()
+        outcome = continuation(client_call_details, request)
+        if outcome.exception() is not None:
+            RPC_ERRORS.labels("grpc", method).inc()
+        return outcome
+
+    def intercept_unary_stream(self, continuation, client_call_details, request):
+        method = _grpc_method_name(client_call_details)
+        RPC_CALLS.labels("grpc", method).inc()
+        try:
+            call = continuation(client_call_details, request)
+        except grpc.RpcError:
+            RPC_ERRORS.labels("grpc", method).inc()
+            raise
+        # Stream errors surface while the responses are read, not when the call is made
+        return _ErrorCountingStream(call, method)
@@ -1,9 +1,24 @@
 from typing import List
 from web3.auto import w3
 from eth_utils import to_checksum_address
-from eth_abi import encode_single, decode_single
 from eth_utils import function_signature_to_4byte_selector
 
+try:
+    from eth_abi import encode_single, decode_single
+except ImportError:
+    # eth_abi 4 dropped the *_single functions, encode a tuple type as its components
+    from eth_abi import encode, decode
+    from eth_abi.grammar import parse
+
+    def _components(types):
+        return [component.to_type_str() for component in parse(types).components]
+
+    def encode_single(types, args):
+        return encode(_components(types), args)
+
+    def decode_single(types, data):
+        return tuple(decode(_components(types), data))
+
 
 def parse_signature(signature):
     """
@@ -11,17 +11,20 @@ from web3._utils.filters import construct_event_filter_params
 from web3._utils.events import get_event_data
 import os
 import shutil
-import traceback
+import threading
 
 import event_handlers
+from deposit_event import DepositEvent
+import log_pipeline
+import metrics
+import sharding
 
-# Load config from JSON file
-with open("config.json", "r") as config_file:
-    config = json.load(config_file)
+from maker_config import config
 
 # Set up connection to Ethereum node
 w3 = Web3(Web3.HTTPProvider(config["provider"]))
 w3.middleware_onion.inject(geth_poa_middleware, layer=0)
+w3.middleware_onion.add(metrics.rpc_metrics_middleware, "metrics")
 
 # Verify connection
 if not w3.is_connected():
@@ -38,16 +41,11 @@ contract = w3.eth.contract(
 
 # Initialize event queue
 event_queue = Queue()
+# Secret hashes being handled or waiting in a withdraw batch
+in_flight = set()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler("event_listener.log"),
-        logging.StreamHandler(),
-    ],
-)
+# Queue-backed logging, configured in main() once settlement workers are started
+log_listener = None
 
 def load_last_block_number(filename="last_block_number.txt"):
     try:
@@ -64,6 +62,15 @@ def save_last_block_number(block_number, filename="last_block_number.txt"):
 last_block_number = load_last_block_number()
 block_chunk_size=1000
 check_interval = 5
+defer_retry_interval = config.get("liquidity", {}).get("defer_retry", 30)
+
+# Settle in several worker processes when settlement.workers > 1
+settlement_config = config.get("settlement", {})
+settlement = None
+if settlement_config.get("workers", 1) > 1:
+    settlement = sharding.ShardedSettlement(
+        "token", settlement_config["workers"], settlement_config.get("shard_by", "secret_hash")
+    )
 
 def check_pending_events():
     pending_dir = 'pending_events'
@@ -73,7 +80,7 @@ def check_pending_events():
     for file in os.listdir(pending_dir):
         filepath = os.path.join(pending_dir, file)
         with open(filepath, 'r') as f:
-            event = json.load(f)
+            event = DepositEvent.from_json(f.read())
         event_queue.put(event)
 
 
@@ -94,12 +101,15 @@ async def fetch_old_events():
             else:
                 to_block = latest_block
             logging.info(f"Fetching events from {start_block} to {to_block}")
+            metrics.BLOCKS_BEHIND.set(latest_block - to_block)
 
             new_entries = w3.eth.get_logs({'fromBlock': start_block, 'toBlock': to_block, 'address': config["token_contract_address"]})
+            metrics.BACKFILL_BLOCKS.inc(max(to_block - start_block + 1, 0))
+            metrics.BACKFILL_EVENTS.inc(len(new_entries))
             event_abi = contract.events[config["event_name"]]._get_event_abi()
             for evt in new_entries:
                 try :
-                    event = get_event_data(w3.codec, event_abi, evt)
+                    event = DepositEvent.from_log(get_event_data(w3.codec, event_abi, evt))
                     converted_event = event_handlers.save_event_to(event, 'pending_events')
                     event_queue.put(converted_event)
                 except Exception as e:
@@ -112,8 +122,7 @@ async def fetch_old_events():
             start_block = to_block + 1
             await asyncio.sleep(check_interval)  # Fetch new events every 5 seconds
         except Exception as e:
-            errormsg = traceback.format_exc()
-            logging.error(f"Failed to fetch events, retrying in 5 seconds\n{str(e)}\n{errormsg}")
+            logging.exception(f"Failed to fetch events, retrying in 5 seconds: {str(e)}")
             await asyncio.sleep(check_interval)  # Retry after 5 seconds in case of errors
 
 
@@ -128,7 +137,7 @@ async def fetch_events():
             event_filter = contract.events[config["event_name"]].createFilter(fromBlock=last_block_number)
             new_entries = event_filter.get_new_entries()
             for event in new_entries:
-                converted_event = event_handlers.save_event_to(event, 'pending_events')
+                converted_event = event_handlers.save_event_to(DepositEvent.from_log(event), 'pending_events')
                 event_queue.put(converted_event)
             if new_entries:
                 last_block_number = new_entries[-1]["blockNumber"]
@@ -144,27 +153,75 @@ async def fetch_events():
 async def process_events():
     while True:
         try:
+            if settlement is not None:
+                settlement.poll()
+                metrics.QUEUE_DEPTH.set(event_queue.qsize() + settlement.in_flight_count())
+            else:
+                metrics.QUEUE_DEPTH.set(event_queue.qsize())
             if not event_queue.empty():
                 event = event_queue.get()
                 if event_handlers.check_event_exists(event, 'completed_events'):
                     continue
+                # Queued again by a restart or a refetch while its withdraw is still in a batch
+                if event.secret_hash in in_flight:
+                    continue
+
+                if settlement is not None:
+                    settlement.dispatch(event)
+                    continue
 
-                event_handler = getattr(event_handlers, f"handle_{config['event_name']}")
-                success = event_handler(event)
-                if success:
-                    event_handlers.move_event(event, 'completed_events')
-                else:
-                    event_handlers.move_event(event, 'error_events')
+                event_id_token = log_pipeline.set_event_id(event.secret_hash)
+                # Added before handling, the batch may report back before the handler returns
+                in_flight.add(event.secret_hash)
+                success = None
+                try:
+                    event_handler = getattr(event_handlers, f"handle_{config['event_name']}")
+                    success = event_handler(event)
+                    if success == event_handlers.DEFERRED:
+                        asyncio.get_running_loop().call_later(defer_retry_interval, event_queue.put, event)
+                    elif success == event_handlers.SUBMITTED:
+                        pass
+                    elif success:
+                        event_handlers.move_event(event, 'completed_events')
+                    else:
+                        event_handlers.move_event(event, 'error_events')
+                finally:
+                    if success != event_handlers.SUBMITTED:
+                        in_flight.discard(event.secret_hash)
+                    log_pipeline.reset_event_id(event_id_token)
             else:
                 logging.info("Event queue is empty, waiting for 1 second")
                 await asyncio.sleep(1)
         except Exception as e:
-            errormsg = traceback.format_exc()
-            logging.error(f"Failed to process events, retrying in 5 seconds\n{str(e)}\n{errormsg}")
+            logging.exception(f"Failed to process events, retrying in 5 seconds: {str(e)}")
             await asyncio.sleep(check_interval)  # Retry after 5 seconds in case of errors
 
+def on_withdraw_done(event, success):
+    in_flight.discard(event.secret_hash)
+    if success is None:
+        # Outcome unknown, handle it again from its checkpoint
+        threading.Timer(defer_retry_interval, event_queue.put, (event,)).start()
+    elif success:
+        event_handlers.move_event(event, 'completed_events')
+    else:
+        event_handlers.move_event(event, 'error_events')
+
 async def main():
+    global log_listener
+
+    # Workers open their own connections, the leader never talks to LND itself
+    if settlement is not None:
+        settlement.start()
+    else:
+        event_handlers.connect()
+
+    log_listener = log_pipeline.setup_logging(config, "token")
+    config.start_watcher(config.get("config_reload_interval", 5))
+    metrics.start_metrics_server(config, "token")
     check_pending_events()
+    if settlement is None:
+        event_handlers.start_liquidity_ledger()
+        event_handlers.start_withdraw_batcher(on_withdraw_done)
     tasks = [
             asyncio.create_task(fetch_old_events()),
             asyncio.create_task(process_events())
@@ -172,4 +229,10 @@ async def main():
     await asyncio.gather(*tasks)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    finally:
+        if settlement is not None:
+            settlement.stop()
+        if log_listener is not None:
+            log_listener.stop()
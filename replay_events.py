@@ -0,0 +1,272 @@
+"""
+Dry-run replay of recorded DepositCreated events through handle_DepositCreated.
+
+Events are read from event folders (completed_events, error_events, ...) and
+JSONL captures, one event per line in the on-disk layout, optionally with
+"oracle_price" and "received_at" (unix time) fields. Payments and withdraw
+transactions are stubbed out, invoices are decoded offline with the bolt11
+library and oracle prices are pinned to the values recorded for each event,
+so no node or LND connection is needed.
+
+    python replay_events.py completed_events error_events capture.jsonl \\
+        --log event_listener_token.log --price usdc=27000 --report replay_report.json
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import statistics
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from types import SimpleNamespace
+
+import bolt11
+
+import event_handlers
+from deposit_event import DepositEvent
+
+ORACLE_PRICE_PATTERN = re.compile(r"^Oracle price is ([0-9.eE+-]+), Order price is")
+EVENT_RECEIVED_PATTERN = re.compile(r"^Event received: \w+, secretHash: ([^,\s]+),")
+# Lines of the text logs written before the JSON log pipeline, e.g. event_listener.log
+TEXT_LOG_PATTERN = re.compile(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) \[\w+\] (.*)$")
+LOG_TIME_FORMAT = "%Y-%m-%d %H:%M:%S,%f"
+
+# Preimage handed to delegate_withdraw in place of a real payment
+REPLAY_SECRET = "0x" + "00" * 32
+
+
+def decode_invoice_offline(invoice):
+    """
+    Read the fields handle_DepositCreated uses from a BOLT11 invoice, shaped
+    like LND's PayReq
+    """
+    if invoice.lower().startswith("lightning:"):
+        invoice = invoice[len("lightning:"):]
+    decoded = bolt11.decode(invoice)
+    return SimpleNamespace(
+        num_satoshis=(decoded.amount_msat or 0) // 1000,
+        payment_hash=decoded.payment_hash,
+        destination=decoded.payee or "",
+        cltv_expiry=decoded.min_final_cltv_expiry,
+        route_hints=decoded.route_hints or [],
+    )
+
+
+def load_events(sources):
+    """
+    Yields (event, recorded) pairs, recorded holding whatever the source knows
+    about the original run: oracle_price, received_at or the file_mtime of an
+    event file, and the source
+    """
+    for source in sources:
+        if os.path.isdir(source):
+            for file in sorted(os.listdir(source)):
+                filepath = os.path.join(source, file)
+                with open(filepath, "r") as f:
+                    event = DepositEvent.from_json(f.read())
+                # The event file was written when the event was fetched and moved with rename
+                yield event, {"file_mtime": os.path.getmtime(filepath), "source": os.path.basename(source)}
+        else:
+            with open(source, "r") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    data = json.loads(line)
+                    recorded = {"source": os.path.basename(source)}
+                    for key in ("oracle_price", "received_at"):
+                        if key in data:
+                            recorded[key] = data[key]
+                    yield DepositEvent.from_dict(data), recorded
+
+
+def load_recorded_logs(log_files):
+    """
+    Oracle prices and receive times per event id from log files. JSON log
+    records carry their event id; in the older text logs events were handled
+    one at a time, so an oracle price belongs to the last event received.
+    """
+    recorded = defaultdict(dict)
+    for log_file in log_files:
+        current_event_id = None
+        with open(log_file, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    event_id = entry.get("event_id")
+                    timestamp = entry.get("ts")
+                    message = entry.get("message", "")
+                except ValueError:
+                    match = TEXT_LOG_PATTERN.match(line.rstrip("\n"))
+                    if match is None:
+                        # Traceback and other continuation lines
+                        continue
+                    timestamp, message = match.groups()
+                    received = EVENT_RECEIVED_PATTERN.match(message)
+                    if received:
+                        current_event_id = received.group(1)
+                    event_id = current_event_id
+                if event_id is None:
+                    continue
+                match = ORACLE_PRICE_PATTERN.match(message)
+                if match:
+                    recorded[event_id]["oracle_price"] = float(match.group(1))
+                elif message.startswith("Event received") and "received_at" not in recorded[event_id]:
+                    recorded[event_id]["received_at"] = datetime.strptime(timestamp, LOG_TIME_FORMAT).timestamp()
+    return recorded
+
+
+class Replay:
+    def __init__(self, pinned_prices):
+        self.pinned_prices = pinned_prices
+        self.results = []
+        self.current = None
+
+    def timed(self, stage, fn):
+        def wrapper(*args):
+            start = time.perf_counter()
+            try:
+                return fn(*args)
+            finally:
+                self.current["stages"][stage] = time.perf_counter() - start
+        return wrapper
+
+    def install(self):
+        event_handlers.get_oracle_price = self.timed("oracle", self.oracle_price)
+        event_handlers.get_invoice_info = self.timed("invoice_decode", self.invoice_info)
+        event_handlers.pay_invoice = self.timed("pay", lambda invoice: REPLAY_SECRET)
+        event_handlers.delegate_withdraw = self.timed("withdraw", lambda *args: True)
+        event_handlers.load_checkpoint = lambda secret_hash: None
+        event_handlers.save_checkpoint = lambda secret_hash, **fields: fields
+        event_handlers.validate_deadline = self.validate_deadline
+        event_handlers.log_event_on_error = self.log_event_on_error
+        event_handlers.liquidity_ledger = None
+        event_handlers.withdraw_batcher = None
+
+    def oracle_price(self, base_asset, quote_asset):
+        if "oracle_price" in self.current["recorded"]:
+            return self.current["recorded"]["oracle_price"]
+        return self.pinned_prices.get(quote_asset.lower())
+
+    def invoice_info(self, invoice):
+        try:
+            return decode_invoice_offline(invoice)
+        except Exception as e:
+            logging.warning(f"Failed to decode invoice: {str(e)}")
+            return None
+
+    def validate_deadline(self, deadline):
+        recorded = self.current["recorded"]
+        received_at = recorded.get("received_at", recorded.get("file_mtime", time.time()))
+        return deadline >= received_at + 1800
+
+    def log_event_on_error(self, error_message, event):
+        self.current["reason"] = error_message
+
+    def run(self, event, recorded):
+        self.current = {"event_id": event.secret_hash, "source": recorded.pop("source", None),
+                        "recorded": recorded, "stages": {}, "reason": None}
+        start = time.perf_counter()
+        try:
+            outcome = event_handlers.handle_DepositCreated(event)
+        except Exception as e:
+            outcome = None
+            self.current["reason"] = f"{type(e).__name__}: {str(e)}"
+        self.current["stages"]["handler"] = time.perf_counter() - start
+
+        if outcome is True:
+            decision = "ignored" if self.current["reason"] else "accepted"
+        elif outcome is False:
+            decision = "rejected"
+        elif outcome is None:
+            decision = "failed"
+        else:
+            decision = outcome
+        self.current["decision"] = decision
+        self.results.append(self.current)
+
+    def report(self, elapsed):
+        timings = defaultdict(list)
+        for result in self.results:
+            for stage, duration in result["stages"].items():
+                timings[stage].append(duration * 1000)
+
+        stages = {}
+        for stage, values in timings.items():
+            values.sort()
+            stages[stage] = {
+                "count": len(values),
+                "mean_ms": statistics.fmean(values),
+                "p50_ms": values[len(values) // 2],
+                "p95_ms": values[min(int(len(values) * 0.95), len(values) - 1)],
+                "max_ms": values[-1],
+            }
+
+        return {
+            "events": len(self.results),
+            "elapsed_seconds": elapsed,
+            "events_per_second": len(self.results) / elapsed if elapsed else None,
+            "decisions": dict(Counter(result["decision"] for result in self.results)),
+            "reasons": dict(Counter(result["reason"] for result in self.results if result["reason"])),
+            "stages": stages,
+        }
+
+
+def parse_prices(values):
+    prices = {}
+    for value in values:
+        asset, price = value.split("=", 1)
+        prices[asset.lower()] = float(price)
+    return prices
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded DepositCreated events without paying or sending transactions")
+    parser.add_argument("sources", nargs="+", help="event folders or JSONL captures")
+    parser.add_argument("--log", action="append", default=[], help="JSON or text log file to read recorded oracle prices and receive times from")
+    parser.add_argument("--contract", choices=["token", "native"], help="swap contract of events recorded without an address")
+    parser.add_argument("--price", action="append", default=[], help="ASSET=PRICE, BTC price in ASSET used when none was recorded")
+    parser.add_argument("--report", help="write the JSON report to this file instead of stdout")
+    parser.add_argument("--events-out", help="write one JSON line per replayed event to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the handler's own log output")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR, format="%(asctime)s [%(levelname)s] %(message)s")
+
+    recorded_logs = load_recorded_logs(args.log)
+    events = []
+    for event, recorded in load_events(args.sources):
+        recorded = {**recorded_logs.get(event.secret_hash, {}), **recorded}
+        events.append((event, recorded))
+    events.sort(key=lambda item: (item[0].block_number or 0, item[0].log_index or 0))
+
+    # Captures may leave out the contract that emitted the event
+    missing_address = [event for event, _ in events if not event.address]
+    if missing_address and args.contract is None:
+        parser.error(f"{len(missing_address)} events have no contract address "
+                     f"(e.g. {missing_address[0].secret_hash}), pass --contract token or --contract native")
+    for event in missing_address:
+        event.address = event_handlers.config[f"{args.contract}_contract_address"]
+
+    replay = Replay(parse_prices(args.price))
+    replay.install()
+    start = time.perf_counter()
+    for event, recorded in events:
+        replay.run(event, recorded)
+    report = replay.report(time.perf_counter() - start)
+
+    if args.events_out:
+        with open(args.events_out, "w") as f:
+            for result in replay.results:
+                f.write(json.dumps(result) + "\n")
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+import logging
+import multiprocessing
+import threading
+import zlib
+
+import event_handlers
+import liquidity
+import log_pipeline
+import metrics
+from maker_config import config
+
+# Workers, including ones replacing a dead worker, are started by a fork server
+# launched on first use as a fresh interpreter. They never inherit the leader's
+# threads, locks or gRPC state, and each one opens its own node and LND
+# connections.
+mp = multiprocessing.get_context("forkserver")
+
+
+def shard_for(event, workers, shard_by="secret_hash"):
+    if shard_by == "token":
+        key = event.token.lower()
+    else:
+        key = event.secret_hash
+    return zlib.crc32(key.encode()) % workers
+
+
+def _worker_main(index, process_name, tasks, results, nonce_lock, liquidity_state):
+    log_listener = log_pipeline.setup_logging(config, f"{process_name}_worker{index}")
+    config.start_watcher(config.get("config_reload_interval", 5))
+    metrics.reset_for_worker()
+    event_handlers.reconnect()
+    metrics.start_metrics_server(config, process_name, index)
+    event_handlers.nonce_lock = nonce_lock
+    event_handlers.start_liquidity_ledger(liquidity_state, index)
+
+    def on_withdraw_done(event, success):
+        if success is None:
+            # Outcome unknown, handle it again from its checkpoint
+            threading.Timer(defer_retry_interval, tasks.put, (event,)).start()
+            return
+        if success:
+            event_handlers.move_event(event, 'completed_events')
+        else:
+            event_handlers.move_event(event, 'error_events')
+        results.put((event.secret_hash, success))
+
+    event_handlers.start_withdraw_batcher(on_withdraw_done)
+    defer_retry_interval = config.get("liquidity", {}).get("defer_retry", 30)
+    event_handler = getattr(event_handlers, f"handle_{config['event_name']}")
+    logging.info(f"Settlement worker {index} started")
+
+    while True:
+        event = tasks.get()
+        if event is None:
+            break
+
+        # A re-dispatched event may have been finished just before the previous owner died
+        if event_handlers.check_event_exists(event, 'completed_events'):
+            results.put((event.secret_hash, True))
+            continue
+
+        event_id_token = log_pipeline.set_event_id(event.secret_hash)
+        try:
+            success = event_handler(event)
+            if success == event_handlers.DEFERRED:
+                # Still owned by this worker, hand it back to itself later
+                threading.Timer(defer_retry_interval, tasks.put, (event,)).start()
+                continue
+            elif success == event_handlers.SUBMITTED:
+                # Reported by on_withdraw_done once the batch is mined
+                continue
+            elif success:
+                event_handlers.move_event(event, 'completed_events')
+            else:
+                event_handlers.move_event(event, 'error_events')
+        except Exception as e:
+            # Left in pending_events like the single process loop does
+            logging.exception(f"Failed to process event: {str(e)}")
+            success = None
+        finally:
+            log_pipeline.reset_event_id(event_id_token)
+        results.put((event.secret_hash, success))
+
+    log_listener.stop()
+
+
+class ShardedSettlement:
+    """
+    Settles events in `workers` worker processes. The calling process stays the
+    leader: it owns ingestion and the block cursor and hands every event to the
+    single worker owning its shard. Events stay in flight until their worker
+    reports back; if a worker dies it is replaced and its in-flight events are
+    handed to the replacement, which skips ones already in completed_events.
+    A reassigned event resumes from its settlement checkpoint: a paid invoice
+    goes straight to the withdraw and a payment that may have been in flight
+    is looked up in LND, so the replacement never pays it again.
+    """
+    def __init__(self, process_name, workers, shard_by="secret_hash"):
+        self.process_name = process_name
+        self.workers = workers
+        self.shard_by = shard_by
+        self.results = mp.Queue()
+        self.nonce_lock = mp.Lock()
+        # Reservations of all workers against the same channel balances
+        self.liquidity_state = liquidity.LedgerState(workers, mp)
+        self.processes = [None] * workers
+        self.tasks = [None] * workers
+        self.in_flight = [{} for _ in range(workers)]
+
+    def start(self):
+        for index in range(self.workers):
+            self._start_worker(index)
+
+    def _start_worker(self, index):
+        self.tasks[index] = mp.Queue()
+        process = mp.Process(
+            target=_worker_main,
+            args=(index, self.process_name, self.tasks[index], self.results, self.nonce_lock,
+                  self.liquidity_state),
+            name=f"{self.process_name}-worker{index}",
+            daemon=True,
+        )
+        process.start()
+        self.processes[index] = process
+
+    def dispatch(self, event):
+        index = shard_for(event, self.workers, self.shard_by)
+        if event.secret_hash in self.in_flight[index]:
+            return
+        self.in_flight[index][event.secret_hash] = event
+        self.tasks[index].put(event)
+
+    def poll(self):
+        while not self.results.empty():
+            secret_hash, success = self.results.get()
+            for in_flight in self.in_flight:
+                in_flight.pop(secret_hash, None)
+
+        for index, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            process.join()
+            logging.error(f"Settlement worker {index} exited with code {process.exitcode}, "
+                          f"restarting and reassigning {len(self.in_flight[index])} events")
+            # The old queue may still hold events, start over with only the in-flight set
+            self.liquidity_state.clear_slot(index)
+            self._start_worker(index)
+            for event in self.in_flight[index].values():
+                self.tasks[index].put(event)
+
+    def in_flight_count(self):
+        return sum(len(in_flight) for in_flight in self.in_flight)
+
+    def stop(self):
+        for tasks in self.tasks:
+            tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=30)
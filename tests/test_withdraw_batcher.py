@@ -0,0 +1,201 @@
+"""
+WithdrawBatcher against Multicall2 and a minimal swap contract on eth-tester.
+Needs the test dependencies (eth-tester[py-evm], py-solc-x, pytest) and a
+solc download on first run.
+"""
+import hashlib
+import os
+from types import SimpleNamespace
+
+import pytest
+
+web3 = pytest.importorskip("web3")
+pytest.importorskip("eth_tester")
+solcx = pytest.importorskip("solcx")
+
+from web3 import Web3, EthereumTesterProvider
+
+from withdraw_batcher import WithdrawBatcher
+
+SOLC_VERSION = "0.8.19"
+
+CONTRACTS = """
+pragma solidity ^0.8.0;
+
+contract Multicall2 {
+    struct Call {
+        address target;
+        bytes callData;
+    }
+
+    struct Result {
+        bool success;
+        bytes returnData;
+    }
+
+    function tryAggregate(bool requireSuccess, Call[] memory calls) public returns (Result[] memory returnData) {
+        returnData = new Result[](calls.length);
+        for (uint256 i = 0; i < calls.length; i++) {
+            (bool success, bytes memory ret) = calls[i].target.call(calls[i].callData);
+            if (requireSuccess) {
+                require(success, "Multicall2 aggregate: call failed");
+            }
+            returnData[i] = Result(success, ret);
+        }
+    }
+}
+
+contract Swap {
+    mapping(bytes32 => address) public withdrawnTo;
+
+    event Withdrawn(bytes32 secretHash, address withdrawer, address token, uint256 amount);
+
+    // Same signature as both swap contracts, the secret is the invoice preimage
+    function delegateWithdraw(bytes memory secret, address account) external {
+        bytes32 secretHash = sha256(secret);
+        require(withdrawnTo[secretHash] == address(0), "already withdrawn");
+        withdrawnTo[secretHash] = account;
+        emit Withdrawn(secretHash, account, address(0), 0);
+    }
+}
+"""
+
+
+@pytest.fixture(scope="module")
+def compiled():
+    try:
+        solcx.install_solc(SOLC_VERSION)
+    except Exception as e:
+        pytest.skip(f"solc {SOLC_VERSION} unavailable: {e}")
+    return solcx.compile_source(CONTRACTS, output_values=["abi", "bin"], solc_version=SOLC_VERSION)
+
+
+def deploy(w3, compiled, name):
+    interface = compiled[f"<stdin>:{name}"]
+    contract = w3.eth.contract(abi=interface["abi"], bytecode=interface["bin"])
+    transaction_hash = contract.constructor().transact({"from": w3.eth.accounts[0]})
+    address = w3.eth.wait_for_transaction_receipt(transaction_hash)["contractAddress"]
+    return w3.eth.contract(address=address, abi=interface["abi"])
+
+
+@pytest.fixture
+def chain(compiled):
+    w3 = Web3(EthereumTesterProvider())
+    bot = w3.eth.account.create()
+    w3.eth.send_transaction({"from": w3.eth.accounts[0], "to": bot.address, "value": 10**19})
+    return SimpleNamespace(
+        w3=w3,
+        bot=bot,
+        aggregator=deploy(w3, compiled, "Multicall2"),
+        swap=deploy(w3, compiled, "Swap"),
+        receiver=w3.eth.accounts[1],
+    )
+
+
+def make_batcher(chain, outcomes):
+    return WithdrawBatcher(
+        chain.w3,
+        chain.aggregator.address,
+        chain.bot.address,
+        chain.bot.key,
+        on_done=lambda event, success: outcomes.__setitem__(event.secret_hash, success),
+    )
+
+
+def make_items(chain, count):
+    items = []
+    for _ in range(count):
+        preimage = os.urandom(32)
+        # Hex string like the preimage pay_invoice returns and settle_withdraw encodes
+        secret = "0x" + preimage.hex()
+        event = SimpleNamespace(secret_hash=hashlib.sha256(preimage).hexdigest(), secret=secret)
+        calldata = chain.swap.encodeABI(fn_name="delegateWithdraw", args=[secret, chain.receiver])
+        items.append((event, chain.swap.address, Web3.to_bytes(hexstr=calldata)))
+    return items
+
+
+def withdrawn(chain, event):
+    return chain.swap.functions.withdrawnTo(bytes.fromhex(event.secret_hash)).call() == chain.receiver
+
+
+def withdraw_directly(chain, event):
+    transaction_hash = chain.swap.functions.delegateWithdraw(event.secret, chain.receiver).transact(
+        {"from": chain.w3.eth.accounts[0]})
+    chain.w3.eth.wait_for_transaction_receipt(transaction_hash)
+
+
+def test_reverting_item_is_dropped_from_batch(chain):
+    outcomes = {}
+    batcher = make_batcher(chain, outcomes)
+    items = make_items(chain, 3)
+    reverting = items[1][0]
+    withdraw_directly(chain, reverting)
+
+    batcher.flush(items)
+
+    assert outcomes == {event.secret_hash: event is not reverting for event, _, _ in items}
+    assert all(withdrawn(chain, event) for event, _, _ in items)
+
+
+def test_item_reverting_after_simulation_is_not_reported_as_withdrawn(chain):
+    outcomes = {}
+    batcher = make_batcher(chain, outcomes)
+    items = make_items(chain, 3)
+    reverting = items[1][0]
+
+    send = batcher._send
+    sent = []
+
+    def send_after_front_run(batch):
+        # The call passed its simulation but reverts inside the mined batch
+        if not sent:
+            withdraw_directly(chain, reverting)
+        result = send(batch)
+        sent.append((len(batch), result))
+        return result
+
+    batcher._send = send_after_front_run
+    batcher.flush(items)
+
+    assert sent == [(3, False), (2, True)]
+    assert outcomes == {event.secret_hash: event is not reverting for event, _, _ in items}
+    assert all(withdrawn(chain, event) for event, _, _ in items)
+
+
+def test_unknown_outcome_leaves_events_pending(chain):
+    outcomes = {}
+    batcher = make_batcher(chain, outcomes)
+    items = make_items(chain, 2)
+
+    def send_failing(batch):
+        raise ConnectionError("node went away")
+
+    batcher._send = send_failing
+    batcher.flush(items)
+
+    assert outcomes == {event.secret_hash: None for event, _, _ in items}
+
+
+def test_event_submitted_twice_is_withdrawn_once(chain):
+    outcomes = []
+    batcher = WithdrawBatcher(
+        chain.w3,
+        chain.aggregator.address,
+        chain.bot.address,
+        chain.bot.key,
+        on_done=lambda event, success: outcomes.append((event.secret_hash, success)),
+    )
+    (item,) = make_items(chain, 1)
+    event = item[0]
+
+    assert batcher.submit(*item)
+    assert not batcher.submit(*item)
+    batch = []
+    while not batcher.queue.empty():
+        batch.append(batcher.queue.get())
+    batcher.flush(batch)
+
+    assert outcomes == [(event.secret_hash, True)]
+    assert withdrawn(chain, event)
+    # Reported, so a later handling of the event may submit it again
+    assert batcher.submit(*item)
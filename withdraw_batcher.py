@@ -0,0 +1,146 @@
+import logging
+import queue
+import threading
+import time
+from contextlib import nullcontext
+
+from multicall import Call
+import metrics
+
+TRY_AGGREGATE = 'tryAggregate(bool,(address,bytes)[])((bool,bytes)[])'
+
+
+class WithdrawBatcher:
+    """
+    Collects delegateWithdraw calls from payments settling close together and
+    submits them as one transaction through a Multicall2 style aggregator.
+    A batch is sent once it holds `max_size` calls or its oldest call has waited
+    `max_delay` seconds. Every call is first simulated with eth_call so calls
+    that would revert are reported as failed instead of taking the batch down.
+    The rest are sent with requireSuccess, so a mined batch means every call in
+    it succeeded; a batch reverted by a call that started failing after the
+    simulation is simulated and sent again.
+
+    on_done(event, success) is called once per submitted event with True, False
+    or None when the outcome is unknown (a node error, or a batch that kept
+    reverting), in which case the event has to be handled again from its
+    checkpoint. on_sent(events, transaction_hash) is called as soon as a batch
+    transaction is sent.
+    """
+    def __init__(self, w3, aggregator_address, bot_address, bot_private_key,
+                 max_size=20, max_delay=10, nonce_lock=None, on_done=None, on_sent=None):
+        self.w3 = w3
+        self.aggregator_address = aggregator_address
+        self.bot_address = bot_address
+        self.bot_private_key = bot_private_key
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.nonce_lock = nonce_lock or nullcontext()
+        self.on_done = on_done
+        self.on_sent = on_sent
+        self.queue = queue.Queue()
+        # Secret hashes submitted and not reported through on_done yet
+        self.held = set()
+        self.held_lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="withdraw-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, event, target, calldata):
+        """
+        Queue a withdraw, False if the event is already waiting in a batch
+        """
+        with self.held_lock:
+            if event.secret_hash in self.held:
+                return False
+            self.held.add(event.secret_hash)
+        self.queue.put((event, target, calldata))
+        return True
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.flush(batch)
+
+    def _aggregate_call(self, batch, require_success):
+        calls = [[target, calldata] for _, target, calldata in batch]
+        return Call(self.aggregator_address, [TRY_AGGREGATE, require_success, calls], None, self.w3)
+
+    def flush(self, batch, attempts=2):
+        pending = list(batch)
+        try:
+            results = self._aggregate_call(batch, False)()
+            for item, (success, _) in zip(batch, results):
+                if not success:
+                    event = item[0]
+                    logging.error(f"[{event.secret_hash}] : delegateWithdraw would revert, dropped from batch",
+                                  extra={"event_id": event.secret_hash})
+                    pending.remove(item)
+                    self._done(event, False)
+
+            if not pending:
+                return
+            if self._send(pending):
+                for event, _, _ in pending:
+                    self._done(event, True)
+                return
+        except Exception as e:
+            logging.exception(f"Failed to send withdraw batch of {len(pending)}, left pending: {str(e)}")
+            for event, _, _ in pending:
+                self._done(event, None)
+            return
+
+        if attempts > 1:
+            logging.warning(f"Withdraw batch of {len(pending)} reverted, simulating it again")
+            self.flush(pending, attempts - 1)
+        else:
+            logging.error(f"Withdraw batch of {len(pending)} reverted again, left pending")
+            for event, _, _ in pending:
+                self._done(event, None)
+
+    def _send(self, batch):
+        calldata = self._aggregate_call(batch, True).data
+        transaction = {
+            'from': self.bot_address,
+            'to': self.aggregator_address,
+            'data': calldata,
+        }
+        with metrics.time_stage("gas_estimate"):
+            transaction['gas'] = int(self.w3.eth.estimate_gas(transaction) * 1.3)
+
+        with self.nonce_lock:
+            transaction['nonce'] = self.w3.eth.get_transaction_count(self.bot_address, 'pending')
+            transaction['gasPrice'] = self.w3.eth.gas_price
+            transaction['chainId'] = self.w3.eth.chain_id
+            signed_transaction = self.w3.eth.account.sign_transaction(transaction, self.bot_private_key)
+            with metrics.time_stage("send"):
+                transaction_hash = self.w3.eth.send_raw_transaction(signed_transaction.rawTransaction)
+
+        logging.info(f"sending withdraw batch of {len(batch)} in transaction {transaction_hash.hex()}")
+        if self.on_sent is not None:
+            self.on_sent([event for event, _, _ in batch], transaction_hash)
+
+        with metrics.time_stage("receipt"):
+            transaction_receipt = self.w3.eth.wait_for_transaction_receipt(transaction_hash)
+        return transaction_receipt['status'] == 1
+
+    def _done(self, event, success):
+        with self.held_lock:
+            self.held.discard(event.secret_hash)
+        if self.on_done is None:
+            return
+        try:
+            self.on_done(event, success)
+        except Exception as e:
+            logging.exception(f"Failed to complete event {event.secret_hash}: {str(e)}")